@@ -4,14 +4,21 @@ Performance comparison script for Docker vs ZIP Lambda endpoints.
 Tests both endpoints 500 times each and compares average response times.
 """
 
-import requests
+import aiohttp
+import asyncio
+import csv
+import functools
+import httpx
 import time
 import json
-import statistics
+import ssl
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import Counter
 import argparse
+import numpy as np
+import orjson
+from pathlib import Path
+from yarl import URL
 
 # Configuration
 DOCKER_ENDPOINT = "https://api.follicle-force-3000.com/process-profile-docker"
@@ -24,156 +31,229 @@ TEST_PAYLOAD = {
     "interests": ["coding", "music", "travel"]
 }
 
+# Serialized once up front instead of on every request
+ENCODED_PAYLOAD = json.dumps(TEST_PAYLOAD).encode("utf-8")
+
 HEADERS = {
-    "Content-Type": "application/json"
+    "Content-Type": "application/json",
+    "Content-Length": str(len(ENCODED_PAYLOAD))
 }
 
-def make_request(endpoint, payload, headers):
+# Checked in order, so more specific exceptions must come before their base classes
+ERROR_TYPES = [
+    ((asyncio.TimeoutError, httpx.TimeoutException), 'timeout', "Timeout after 30s"),
+    ((aiohttp.ClientConnectionError, httpx.NetworkError), 'connection', "Connection error"),
+    ((aiohttp.ClientError, httpx.HTTPError), 'request', "Request error"),
+]
+
+async def make_request(session, endpoint, payload, headers):
     """Make a single request and return the response time in milliseconds."""
-    start_time = time.time()
-    error_details = None
+    start = time.perf_counter_ns()
     response_text = None
 
     try:
-        response = requests.post(endpoint, json=payload, headers=headers, timeout=30)
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-
-        # Get response text for error analysis
-        try:
-            response_text = response.text
-        except:
-            response_text = "Unable to read response text"
+        # Response text is only decoded for failures, where it's kept for error analysis
+        if isinstance(session, httpx.AsyncClient):
+            response = await session.post(endpoint, content=payload, headers=headers)
+            status_code = response.status_code
+            if status_code != 200:
+                response_text = response.text
+        else:
+            async with session.post(endpoint, data=payload, headers=headers) as response:
+                status_code = response.status
+                if status_code != 200:
+                    try:
+                        response_text = await response.text()
+                    except Exception:
+                        response_text = "Unable to read response text"
+                else:
+                    # aiohttp closes connections whose body wasn't read, so drain it
+                    # (without decoding) to hand the connection back to the pool
+                    await response.read()
+        response_time_ms = (time.perf_counter_ns() - start) / 1_000_000.0
 
         return {
             'response_time_ms': response_time_ms,
-            'status_code': response.status_code,
-            'success': response.status_code == 200,
-            'response_text': response_text if response.status_code != 200 else None,
+            'status_code': status_code,
+            'success': status_code == 200,
+            'response_text': response_text,
             'error': None,
             'error_type': None
         }
-    except requests.exceptions.Timeout as e:
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-        error_details = f"Timeout after 30s: {str(e)}"
-        print(f"⚠️  Timeout error: {error_details}", file=sys.stderr)
-        return {
-            'response_time_ms': response_time_ms,
-            'status_code': None,
-            'success': False,
-            'response_text': None,
-            'error': error_details,
-            'error_type': 'timeout'
-        }
-    except requests.exceptions.ConnectionError as e:
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-        error_details = f"Connection error: {str(e)}"
-        print(f"⚠️  Connection error: {error_details}", file=sys.stderr)
-        return {
-            'response_time_ms': response_time_ms,
-            'status_code': None,
-            'success': False,
-            'response_text': None,
-            'error': error_details,
-            'error_type': 'connection'
-        }
-    except requests.exceptions.RequestException as e:
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-        error_details = f"Request error: {str(e)}"
-        print(f"⚠️  Request error: {error_details}", file=sys.stderr)
-        return {
-            'response_time_ms': response_time_ms,
-            'status_code': None,
-            'success': False,
-            'response_text': None,
-            'error': error_details,
-            'error_type': 'request'
-        }
     except Exception as e:
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-        error_details = f"Unexpected error: {str(e)}"
-        print(f"⚠️  Unexpected error: {error_details}", file=sys.stderr)
+        response_time_ms = (time.perf_counter_ns() - start) / 1_000_000.0
+        error_type, label = next(
+            ((error_type, label) for types, error_type, label in ERROR_TYPES if isinstance(e, types)),
+            ('unexpected', "Unexpected error")
+        )
+        if error_type == 'connection' and isinstance(session, aiohttp.ClientSession):
+            # The resolved address may be stale, so look the host up again next time
+            url = URL(endpoint)
+            session.connector.clear_dns_cache(url.host, url.port)
+        error_details = f"{label}: {str(e)}"
+        print(f"⚠️  {error_details}", file=sys.stderr)
         return {
             'response_time_ms': response_time_ms,
             'status_code': None,
             'success': False,
             'response_text': None,
             'error': error_details,
-            'error_type': 'unexpected'
+            'error_type': error_type
         }
 
-def test_endpoint(endpoint_name, endpoint_url, num_requests=500, max_workers=10):
+def create_client(max_workers, http2=False):
+    """Create the HTTP client shared by every endpoint test."""
+    # One TLS context for every connection, so the CA bundle is loaded and parsed once
+    ssl_context = ssl.create_default_context()
+
+    if http2:
+        ssl_context.set_alpn_protocols(["h2", "http/1.1"])
+        # HTTP/2 multiplexes every request as a stream over a single TLS connection
+        return httpx.AsyncClient(
+            http2=True,
+            verify=ssl_context,
+            limits=httpx.Limits(max_connections=max_workers, max_keepalive_connections=max_workers),
+            timeout=30.0
+        )
+
+    # aiohttp only speaks HTTP/1.1, so don't let the server negotiate h2
+    ssl_context.set_alpn_protocols(["http/1.1"])
+    # DNS answers are cached for the whole run and only dropped on connection errors
+    connector = aiohttp.TCPConnector(
+        limit=max_workers, limit_per_host=max_workers, ttl_dns_cache=None, ssl=ssl_context
+    )
+    return aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=30)
+    )
+
+async def run_requests(send_request, num_requests, max_workers, handle_result):
+    """Send num_requests requests with at most max_workers in flight, passing each result to handle_result."""
+    # Results are handed back through a queue rather than kept on the tasks,
+    # so each one can be freed as soon as it has been handled
+    completed = asyncio.Queue()
+
+    # Like executor.map: a fixed pool of workers takes request slots from a shared
+    # iterator, so only max_workers requests are ever in flight (the client's pool is
+    # just sized to match). A request's clock starts only once a worker picks it up,
+    # so queueing isn't counted as response time.
+    slots = iter(range(num_requests))
+
+    async def worker():
+        for _ in slots:
+            completed.put_nowait(await send_request())
+
+    # Workers and collection share a task group: if a worker dies, the collection loop
+    # is cancelled and the error is raised here instead of waiting forever on the queue
+    async with asyncio.TaskGroup() as workers:
+        for _ in range(min(max_workers, num_requests)):
+            workers.create_task(worker())
+
+        for _ in range(num_requests):
+            handle_result(await completed.get())
+
+async def warm_up_endpoint(session, endpoint_name, endpoint_url, max_workers=64, num_requests=None):
+    """Send unmeasured requests to an endpoint and return their response times."""
+    # By default send one warm-up request per worker
+    if num_requests is None:
+        num_requests = max_workers
+    if not num_requests:
+        return []
+
+    print(f"\n🔥 Warming up {endpoint_name} endpoint with {num_requests} requests...")
+
+    # Warm up at full concurrency: with at least one request per worker, every
+    # connection the measured run will use gets its TLS handshake here, and the Lambda
+    # has already scaled out to max_workers concurrent invocations, so those cold
+    # starts stay out of the statistics too
+    send_request = functools.partial(make_request, session, endpoint_url, ENCODED_PAYLOAD, HEADERS)
+    warmup_times = []
+    await run_requests(
+        send_request, num_requests, max_workers,
+        lambda result: warmup_times.append(result['response_time_ms'])
+    )
+    return warmup_times
+
+# Concurrency model: every request is an I/O-bound HTTP call, so a single asyncio event
+# loop drives them all. Threads would add a stack and context switches per worker for
+# no gain, and a process pool would be worse still (roughly 20 MB RSS per worker and
+# about half the throughput of threads for this kind of workload), so it isn't offered.
+async def test_endpoint(session, endpoint_name, endpoint_url, num_requests=500, max_workers=64, warmup_times=()):
     """Test an endpoint with multiple concurrent requests."""
     print(f"\n🚀 Testing {endpoint_name} endpoint...")
     print(f"URL: {endpoint_url}")
-    print(f"Requests: {num_requests}, Max Workers: {max_workers}")
+    print(f"Requests: {num_requests}, Max Workers: {max_workers}, Warm-up: {len(warmup_times)}")
     print("-" * 60)
 
-    results = []
+    # Every request to this endpoint uses the same arguments, so bind them once
+    send_request = functools.partial(make_request, session, endpoint_url, ENCODED_PAYLOAD, HEADERS)
+
+    # Only failures are kept as dicts; successful timings go straight into an array
+    times = np.empty(num_requests, dtype=np.float64)
+    failures = []
+    status_codes = Counter()
+    error_types = Counter()
+    sample_by_type = {}
     successful_requests = 0
     failed_requests = 0
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all requests
-        futures = [
-            executor.submit(make_request, endpoint_url, TEST_PAYLOAD, HEADERS)
-            for _ in range(num_requests)
-        ]
+    def record_result(result):
+        nonlocal successful_requests, failed_requests
 
-        # Collect results with progress indication
-        for i, future in enumerate(as_completed(futures), 1):
-            result = future.result()
-            results.append(result)
+        if result['status_code'] is not None:
+            status_codes[result['status_code']] += 1
 
-            if result['success']:
-                successful_requests += 1
-            else:
-                failed_requests += 1
+        if result['success']:
+            times[successful_requests] = result['response_time_ms']
+            successful_requests += 1
+        else:
+            failures.append(result)
+            failed_requests += 1
+            error_type = result['error_type']
+            if error_type:
+                error_types[error_type] += 1
+                sample_by_type.setdefault(error_type, result)
 
-            # Show progress every 50 requests
-            if i % 50 == 0 or i == num_requests:
-                print(f"Progress: {i}/{num_requests} requests completed")
+        # Show progress every 50 requests
+        done = successful_requests + failed_requests
+        if done % 50 == 0 or done == num_requests:
+            print(f"Progress ({endpoint_name}): {done}/{num_requests} requests completed")
 
-    # Calculate statistics for successful requests only
-    successful_times = [r['response_time_ms'] for r in results if r['success']]
+    await run_requests(send_request, num_requests, max_workers, record_result)
 
-    # Collect error statistics
-    failed_results = [r for r in results if not r['success']]
-    error_types = Counter([r['error_type'] for r in failed_results if r['error_type']])
-    status_codes = Counter([r['status_code'] for r in results if r['status_code'] is not None])
+    # Calculate statistics for successful requests only
+    successful_times = times[:successful_requests]
 
     # Get sample errors for analysis
-    sample_errors = []
-    for error_type in error_types.keys():
-        sample = next((r for r in failed_results if r['error_type'] == error_type), None)
-        if sample:
-            sample_errors.append({
-                'error_type': error_type,
-                'error_message': sample['error'],
-                'response_text': sample.get('response_text', 'No response text')
-            })
-
-    if successful_times:
+    sample_errors = [
+        {
+            'error_type': error_type,
+            'error_message': sample['error'],
+            'response_text': sample.get('response_text', 'No response text')
+        }
+        for error_type, sample in sample_by_type.items()
+    ]
+
+    if successful_requests:
+        # np.percentile selects with np.partition (O(N), no full sort) and interpolates
+        # linearly, so p95/p99 stay meaningful even for runs under 100 requests
+        p50, p95, p99 = np.percentile(successful_times, [50, 95, 99])
         stats = {
             'endpoint_name': endpoint_name,
             'total_requests': num_requests,
             'successful_requests': successful_requests,
             'failed_requests': failed_requests,
             'success_rate': (successful_requests / num_requests) * 100,
-            'avg_response_time_ms': statistics.mean(successful_times),
-            'median_response_time_ms': statistics.median(successful_times),
-            'min_response_time_ms': min(successful_times),
-            'max_response_time_ms': max(successful_times),
-            'std_dev_ms': statistics.stdev(successful_times) if len(successful_times) > 1 else 0,
-            'p95_response_time_ms': statistics.quantiles(successful_times, n=20)[18] if len(successful_times) >= 20 else max(successful_times),
-            'p99_response_time_ms': statistics.quantiles(successful_times, n=100)[98] if len(successful_times) >= 100 else max(successful_times),
+            'avg_response_time_ms': float(successful_times.mean()),
+            'median_response_time_ms': float(p50),
+            'min_response_time_ms': float(successful_times.min()),
+            'max_response_time_ms': float(successful_times.max()),
+            'std_dev_ms': float(successful_times.std(ddof=1)) if successful_requests > 1 else 0,
+            'p95_response_time_ms': float(p95),
+            'p99_response_time_ms': float(p99),
             'error_breakdown': dict(error_types),
             'status_code_breakdown': dict(status_codes),
-            'sample_errors': sample_errors
+            'sample_errors': sample_errors,
+            'warmup_ms': list(warmup_times)
         }
     else:
         stats = {
@@ -191,9 +271,15 @@ def test_endpoint(endpoint_name, endpoint_url, num_requests=500, max_workers=10)
             'p99_response_time_ms': 0,
             'error_breakdown': dict(error_types),
             'status_code_breakdown': dict(status_codes),
-            'sample_errors': sample_errors
+            'sample_errors': sample_errors,
+            'warmup_ms': list(warmup_times)
         }
 
+    results = {
+        'response_times_ms': successful_times,
+        'failures': failures
+    }
+
     return stats, results
 
 def print_results(stats):
@@ -275,7 +361,7 @@ def print_comparison(docker_stats, zip_stats):
         print("⚠️  Cannot compare - one or both endpoints had no successful requests")
 
 def save_results_to_file(docker_stats, zip_stats, docker_results, zip_results):
-    """Save detailed results to JSON files."""
+    """Save a JSON summary and per-request results as CSV."""
     timestamp = time.strftime("%Y%m%d_%H%M%S")
 
     # Save summary
@@ -286,66 +372,112 @@ def save_results_to_file(docker_stats, zip_stats, docker_results, zip_results):
         'zip_stats': zip_stats
     }
 
-    with open(f'performance_test_summary_{timestamp}.json', 'w') as f:
-        json.dump(summary, f, indent=2)
-
-    # Save detailed results
-    detailed = {
-        'test_timestamp': timestamp,
-        'docker_results': docker_results,
-        'zip_results': zip_results
-    }
-
-    with open(f'performance_test_detailed_{timestamp}.json', 'w') as f:
-        json.dump(detailed, f, indent=2)
+    # Status code breakdowns are keyed by int, hence OPT_NON_STR_KEYS
+    Path(f'performance_test_summary_{timestamp}.json').write_bytes(
+        orjson.dumps(summary, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    )
+
+    # Save detailed results, one row per request
+    with open(f'performance_test_detailed_{timestamp}.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            'endpoint', 'response_time_ms', 'status_code', 'success', 'error_type', 'error', 'response_text'
+        ])
+        for endpoint_name, results in (('Docker', docker_results), ('ZIP', zip_results)):
+            if not results:
+                continue
+            writer.writerows(
+                (endpoint_name, response_time_ms, 200, True, None, None, None)
+                for response_time_ms in results['response_times_ms'].tolist()
+            )
+            writer.writerows(
+                (endpoint_name, r['response_time_ms'], r['status_code'], False,
+                 r['error_type'], r['error'], r['response_text'])
+                for r in results['failures']
+            )
 
     print(f"\n💾 Results saved to:")
     print(f"  - performance_test_summary_{timestamp}.json")
-    print(f"  - performance_test_detailed_{timestamp}.json")
-
-def main():
+    print(f"  - performance_test_detailed_{timestamp}.csv")
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def non_negative_int(value):
+    """argparse type for counts that may be zero but not negative."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative, got {number}")
+    return number
+
+async def main():
     parser = argparse.ArgumentParser(description='Performance test for Lambda endpoints')
-    parser.add_argument('--requests', '-r', type=int, default=500, help='Number of requests per endpoint (default: 500)')
-    parser.add_argument('--workers', '-w', type=int, default=10, help='Max concurrent workers (default: 10)')
+    parser.add_argument('--requests', '-r', type=non_negative_int, default=500, help='Number of requests per endpoint (default: 500)')
+    parser.add_argument('--workers', '-w', type=positive_int, default=64, help='Max concurrent in-flight requests (default: 64)')
     parser.add_argument('--docker-only', action='store_true', help='Test only Docker endpoint')
     parser.add_argument('--zip-only', action='store_true', help='Test only ZIP endpoint')
+    parser.add_argument('--warmup', type=non_negative_int, default=None, help='Unmeasured warm-up requests per endpoint, sent at full concurrency (default: same as --workers)')
+    parser.add_argument('--http2', action='store_true', help='Multiplex requests over HTTP/2 using httpx')
 
     args = parser.parse_args()
+    if args.warmup is None:
+        args.warmup = args.workers
 
     print("🔥 Lambda Performance Test")
     print("=" * 60)
     print(f"Test Configuration:")
     print(f"  Requests per endpoint: {args.requests}")
     print(f"  Max concurrent workers: {args.workers}")
+    print(f"  Warm-up requests per endpoint: {args.warmup}")
+    print(f"  HTTP/2: {args.http2}")
     print(f"  Test payload: {json.dumps(TEST_PAYLOAD, indent=2)}")
 
-    docker_stats = None
-    zip_stats = None
-    docker_results = []
-    zip_results = []
-
+    endpoints = {}
     if not args.zip_only:
-        # Test Docker endpoint
-        docker_stats, docker_results = test_endpoint(
-            "Docker", DOCKER_ENDPOINT, args.requests, args.workers
-        )
-        print_results(docker_stats)
-
+        endpoints["Docker"] = DOCKER_ENDPOINT
     if not args.docker_only:
-        # Test ZIP endpoint
-        zip_stats, zip_results = test_endpoint(
-            "ZIP", ZIP_ENDPOINT, args.requests, args.workers
-        )
-        print_results(zip_stats)
+        endpoints["ZIP"] = ZIP_ENDPOINT
+
+    # The endpoints are tested concurrently so both see the same network conditions.
+    # They share a host, so one client (sized for all tests at once) serves them all.
+    async with create_client(args.workers * len(endpoints), args.http2) as session:
+        # Warm up every endpoint before measuring any, so no measured run overlaps
+        # another endpoint's burst of warm-up cold starts. Task groups (not gather)
+        # cancel the sibling tests if one fails, before the shared client is closed.
+        async with asyncio.TaskGroup() as group:
+            warmups = {
+                name: group.create_task(warm_up_endpoint(session, name, url, args.workers, args.warmup))
+                for name, url in endpoints.items()
+            }
+
+        async with asyncio.TaskGroup() as group:
+            tests = {
+                name: group.create_task(test_endpoint(
+                    session, name, url, args.requests, args.workers, warmups[name].result()
+                ))
+                for name, url in endpoints.items()
+            }
+
+    outcomes_by_name = {name: task.result() for name, task in tests.items()}
+
+    for stats, _ in outcomes_by_name.values():
+        print_results(stats)
+
+    docker_stats, docker_results = outcomes_by_name.get("Docker", (None, {}))
+    zip_stats, zip_results = outcomes_by_name.get("ZIP", (None, {}))
 
     # Compare results if both were tested
     if docker_stats and zip_stats:
         print_comparison(docker_stats, zip_stats)
         save_results_to_file(docker_stats, zip_stats, docker_results, zip_results)
     elif docker_stats:
-        save_results_to_file(docker_stats, {}, docker_results, [])
+        save_results_to_file(docker_stats, {}, docker_results, {})
     elif zip_stats:
-        save_results_to_file({}, zip_stats, [], zip_results)
+        save_results_to_file({}, zip_stats, {}, zip_results)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())